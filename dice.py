@@ -13,7 +13,9 @@
 #
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
-from typing import Match, Union, Any, Type
+from typing import Match, Union, Any, Type, Tuple, Mapping, Optional, List
+from types import MappingProxyType
+import functools
 import operator
 import random
 import math
@@ -24,7 +26,36 @@ from mautrix.util.config import BaseProxyConfig, ConfigUpdateHelper
 from maubot import Plugin, MessageEvent
 from maubot.handlers import command
 
-pattern_regex = re.compile("([0-9]{0,9})[dD]([0-9]{1,9})")
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+_RNG = np.random.default_rng() if np else None
+# Number of dice from which one NumPy call is faster than the getrandbits loop.
+_NUMPY_THRESHOLD = 100
+
+try:
+    from numba import njit
+except ImportError:
+    njit = None
+
+if njit is not None:
+    @njit
+    def _jit_sum(number: int, low: int, high: int) -> int:
+        total = 0
+        for _ in range(number):
+            total += np.random.randint(low, high + 1)
+        return total
+else:
+    _jit_sum = None
+
+# Number of dice in a single XdY above which the numba kernel is used, if available.
+_JIT_THRESHOLD = 1000
+
+pattern_regex = re.compile(r"(?<![0-9])([0-9]{0,9})[dD]([0-9]{1,9})(?![0-9])")
+number_regex = re.compile(r"-?(?:0|[1-9][0-9]*)(?:\.[0-9]+)?")
+name_regex = re.compile(r"[A-Za-z_][A-Za-z0-9_]*")
 
 _OP_MAP = {
     ast.Add: operator.add,
@@ -63,7 +94,7 @@ _ALLOWED_FUNCS = ["ceil", "copysign", "fabs", "factorial", "gcd", "remainder", "
                   "acosh", "asinh", "atanh", "cosh", "sinh", "tanh",
                   "erf", "erfc", "gamma", "lgamma"]
 
-_FUNC_MAP = {
+_FUNC_MAP = MappingProxyType({
     **{func: getattr(math, func) for func in _ALLOWED_FUNCS if hasattr(math, func)},
     "round": round,
     "hash": hash,
@@ -72,8 +103,17 @@ _FUNC_MAP = {
     "float": float,
     "int": int,
     "abs": abs,
+})
+
+_CONST_MAP = {
+    "pi": math.pi,
+    "tau": math.tau,
+    "e": math.e,
 }
 
+# Every name the calculator accepts, including the special-cased ord().
+_KNOWN_NAMES = frozenset(_CONST_MAP.keys() | _FUNC_MAP.keys() | {"ord"})
+
 _FUNC_LIMITS = {
     "factorial": 1000,
     "exp": 709,
@@ -83,77 +123,147 @@ _FUNC_LIMITS = {
 _ARG_COUNT_LIMIT = 5
 
 
+@functools.lru_cache(maxsize=256)
+def _gauss_params(number: int, size: int) -> Tuple[float, float]:
+    mean = number * (size + 1) / 2
+    variance = number * (size ** 2 - 1) / 12
+    return mean, math.sqrt(variance)
+
+
+def _sum_dice(number: int, size: int, rolls: Optional[List[int]] = None) -> int:
+    # Same rejection sampling as random.randint, but with the bit count
+    # computed once per XdY instead of on every roll.
+    getrandbits = random.getrandbits
+    bits = (size - 1).bit_length()
+    total = 0
+    for i in range(number):
+        roll = getrandbits(bits)
+        while roll >= size:
+            roll = getrandbits(bits)
+        roll += 1
+        if rolls is not None:
+            rolls.append(roll)
+        total += roll
+    return total
+
+
+def _roll_gauss(number: int, size: int) -> int:
+    mean, stdev = _gauss_params(number, size)
+    if _RNG is not None:
+        # Draw candidates in batches so a rejected sample doesn't cost a full RNG call.
+        while True:
+            candidates = _RNG.normal(mean, stdev, size=64).astype(np.int64)
+            valid = candidates[(candidates >= number) & (candidates <= number * size)]
+            if valid.size:
+                return int(valid[0])
+    result = 0
+    while result < number or result > number * size:
+        result = int(random.gauss(mean, stdev))
+    return result
+
+
+def _match_dice(match: Match) -> Tuple[int, int]:
+    return int(match.group(1) or "1"), int(match.group(2))
+
+
 # AST-based calculator from https://stackoverflow.com/a/33030616/2120293
-class Calc(ast.NodeVisitor):
-    def visit_BinOp(self, node: ast.BinOp) -> Any:
-        left = self.visit(node.left)
-        right = self.visit(node.right)
-        op_type = type(node.op)
-        try:
-            left_max, right_max = _OP_LIMITS[op_type]
-            if left > left_max or right > right_max:
-                raise ValueError(f"Value over bounds in operator {op_type.__name__}")
-        except KeyError:
-            pass
-        try:
-            op = _OP_MAP[op_type]
-        except KeyError:
-            raise SyntaxError(f"Operator {op_type.__name__} not allowed")
-        return op(left, right)
+def _visit(node: ast.AST) -> Any:
+    try:
+        visitor = _DISPATCH[type(node)]
+    except KeyError:
+        raise SyntaxError(f"{type(node).__name__} not allowed")
+    return visitor(node)
 
-    def visit_UnaryOp(self, node: ast.UnaryOp) -> Any:
-        operand = self.visit(node.operand)
-        try:
-            op = _OP_MAP[type(node.op)]
-        except KeyError:
-            raise SyntaxError(f"Operator {type(node.op).__name__} not allowed")
-        return op(operand)
-
-    def visit_Num(self, node: ast.Num) -> Any:
-        if node.n > _NUM_MAX or node.n < _NUM_MIN:
-            raise ValueError(f"Number out of bounds")
-        return node.n
-
-    def visit_Name(self, node: ast.Name) -> Any:
-        if node.id == "pi":
-            return math.pi
-        elif node.id == "tau":
-            return math.tau
-        elif node.id == "e":
-            return math.e
-
-    def visit_Call(self, node: ast.Call) -> Any:
-        if isinstance(node.func, ast.Name):
-            if node.func.id == "ord" and len(node.args) == 1 and isinstance(node.args[0], ast.Str):
-                return ord(node.args[0].s)
-            try:
-                func = _FUNC_MAP[node.func.id]
-            except KeyError:
-                raise NameError(f"Function {node.func.id} is not defined")
-            args = [self.visit(arg) for arg in node.args]
-            kwargs = {kwarg.arg: self.visit(kwarg.value) for kwarg in node.keywords}
-            if len(args) + len(kwargs) > _ARG_COUNT_LIMIT:
-                raise ValueError("Too many arguments")
-            try:
-                limit = _FUNC_LIMITS[node.func.id]
-                for value in args:
-                    if value > limit:
-                        raise ValueError(f"Value over bounds for function {node.func.id}")
-                for value in kwargs.values():
-                    if value > limit:
-                        raise ValueError(f"Value over bounds for function {node.func.id}")
-            except KeyError:
-                pass
-            return func(*args, **kwargs)
-        raise SyntaxError("Indirect call")
-
-    def visit_Expr(self, node: ast.Expr) -> Any:
-        return self.visit(node.value)
 
-    @classmethod
-    def evaluate(cls, expression: str) -> Union[int, float]:
-        tree = ast.parse(expression)
-        return cls().visit(tree.body[0])
+# The lookup tables are bound as default arguments so the hot visitors read them
+# as locals instead of globals.
+def _visit_binop(node: ast.BinOp, _ops: Mapping = _OP_MAP,
+                 _limits: Mapping = _OP_LIMITS) -> Any:
+    left = _visit(node.left)
+    right = _visit(node.right)
+    op_type = type(node.op)
+    limits = _limits.get(op_type)
+    if limits is not None and (left > limits[0] or right > limits[1]):
+        raise ValueError(f"Value over bounds in operator {op_type.__name__}")
+    op = _ops.get(op_type)
+    if op is None:
+        raise SyntaxError(f"Operator {op_type.__name__} not allowed")
+    return op(left, right)
+
+
+def _visit_unaryop(node: ast.UnaryOp, _ops: Mapping = _OP_MAP) -> Any:
+    operand = _visit(node.operand)
+    op = _ops.get(type(node.op))
+    if op is None:
+        raise SyntaxError(f"Operator {type(node.op).__name__} not allowed")
+    return op(operand)
+
+
+def _visit_constant(node: ast.Constant) -> Any:
+    if type(node.value) not in (int, float):
+        raise SyntaxError(f"Constant {node.value!r} not allowed")
+    if node.value > _NUM_MAX or node.value < _NUM_MIN:
+        raise ValueError(f"Number out of bounds")
+    return node.value
+
+
+def _visit_name(node: ast.Name) -> Any:
+    value = _CONST_MAP.get(node.id)
+    if value is None:
+        raise NameError(f"Name {node.id} is not defined")
+    return value
+
+
+def _visit_call(node: ast.Call, _funcs: Mapping = _FUNC_MAP,
+                _limits: Mapping = _FUNC_LIMITS) -> Any:
+    if isinstance(node.func, ast.Name):
+        if (node.func.id == "ord" and len(node.args) == 1
+                and isinstance(node.args[0], ast.Constant)
+                and isinstance(node.args[0].value, str)):
+            return ord(node.args[0].value)
+        func = _funcs.get(node.func.id)
+        if func is None:
+            raise NameError(f"Function {node.func.id} is not defined")
+        args = [_visit(arg) for arg in node.args]
+        kwargs = {kwarg.arg: _visit(kwarg.value) for kwarg in node.keywords}
+        if len(args) + len(kwargs) > _ARG_COUNT_LIMIT:
+            raise ValueError("Too many arguments")
+        limit = _limits.get(node.func.id)
+        if limit is not None:
+            for value in args:
+                if value > limit:
+                    raise ValueError(f"Value over bounds for function {node.func.id}")
+            for value in kwargs.values():
+                if value > limit:
+                    raise ValueError(f"Value over bounds for function {node.func.id}")
+        return func(*args, **kwargs)
+    raise SyntaxError("Indirect call")
+
+
+_DISPATCH = {
+    ast.BinOp: _visit_binop,
+    ast.UnaryOp: _visit_unaryop,
+    ast.Constant: _visit_constant,
+    ast.Name: _visit_name,
+    ast.Call: _visit_call,
+}
+
+
+# Dice are substituted before evaluation, so the result only depends on the
+# expression string and the whole walk can be cached, not just the parse.
+@functools.lru_cache(maxsize=512)
+def _evaluate_cached(expression: str) -> Union[int, float]:
+    return _visit(ast.parse(expression, mode="eval").body)
+
+
+def evaluate(expression: str) -> Union[int, float]:
+    if number_regex.fullmatch(expression):
+        # Plain numbers, e.g. a single XdY, don't need the AST or a cache slot.
+        value = float(expression) if "." in expression else int(expression)
+        if value > _NUM_MAX or value < _NUM_MIN:
+            raise ValueError("Number out of bounds")
+        return value
+    return _evaluate_cached(expression)
 
 
 class Config(BaseProxyConfig):
@@ -200,8 +310,46 @@ class DiceBot(Plugin):
             await evt.reply("Bad pattern 3:<")
             return
         self.log.debug(f"Handling `{pattern}` from {evt.sender}")
+        result = self._compute(pattern)
+        if result is None:
+            await evt.reply("Bad pattern 3:<")
+            return
+        await evt.reply(result)
+
+    def _compute(self, pattern: str) -> Optional[str]:
+        # Read the config into locals once: the per-XdY helpers below use it on every call,
+        # and the whole roll sees one consistent config.
+        show_rolls = self.show_rolls
+        show_rolls_limit = self.show_rolls_limit
+        gauss_limit = self.gauss_limit
+        show_statement = self.show_statement
+        result_max_length = self.result_max_length
+        round_decimals = self.round_decimals
+        individual_rolls = [] if show_rolls else None
 
-        individual_rolls = [] if self.show_rolls else None
+        def show_individual(number: int) -> bool:
+            return show_rolls and number < show_rolls_limit
+
+        def rolled_individually(number: int, size: int) -> bool:
+            if size <= 1 or number == 0 or number >= gauss_limit:
+                return False
+            return not (_jit_sum is not None and number > _JIT_THRESHOLD
+                        and not show_individual(number))
+
+        # With NumPy, dice of the same size that appear more than once, e.g. in 60d6+60d6,
+        # are rolled in a single batch up front and handed out to each XdY in order.
+        pools = {}
+        if _RNG is not None:
+            totals = {}
+            counts = {}
+            for match in pattern_regex.finditer(pattern):
+                number, size = _match_dice(match)
+                if rolled_individually(number, size):
+                    totals[size] = totals.get(size, 0) + number
+                    counts[size] = counts.get(size, 0) + 1
+            pools = {size: (_RNG.integers(1, size + 1, size=total, dtype=np.int64), 0)
+                     for size, total in totals.items()
+                     if counts[size] > 1 and total >= _NUMPY_THRESHOLD}
 
         def randomize(number: int, size: int) -> int:
             if size < 0 or number < 0:
@@ -211,44 +359,54 @@ class DiceBot(Plugin):
             elif size == 1:
                 return number
             _result = 0
-            if number < self.gauss_limit:
-                individual = [] if self.show_rolls and number < self.show_rolls_limit else None
-                for i in range(number):
-                    roll = random.randint(1, size)
-                    if individual is not None:
-                        individual.append(roll)
-                    _result += roll
-                if individual:
-                    individual_rolls.append((number, size, individual))
+            if rolled_individually(number, size):
+                show = show_individual(number)
+                if size in pools:
+                    pool, offset = pools[size]
+                    pools[size] = (pool, offset + number)
+                    rolls = pool[offset:offset + number]
+                    _result = int(rolls.sum())
+                elif _RNG is not None and number >= _NUMPY_THRESHOLD:
+                    rolls = _RNG.integers(1, size + 1, size=number, dtype=np.int64)
+                    _result = int(rolls.sum())
+                else:
+                    rolls = [] if show else None
+                    _result = _sum_dice(number, size, rolls)
+                if show:
+                    individual_rolls.append((number, size, rolls))
+            elif number < gauss_limit:
+                _result = _jit_sum(number, 1, size)
             else:
-                mean = number * (size + 1) / 2
-                variance = number * (size ** 2 - 1) / 12
-                while _result < number or _result > number * size:
-                    _result = int(random.gauss(mean, math.sqrt(variance)))
+                _result = _roll_gauss(number, size)
             return _result
 
         def replacer(match: Match) -> str:
-            number = int(match.group(1) or "1")
-            size = int(match.group(2))
-            return str(randomize(number, size))
+            return str(randomize(*_match_dice(match)))
 
-        pattern = pattern_regex.sub(replacer, pattern)
+        pattern, substitutions = pattern_regex.subn(replacer, pattern)
+        if (substitutions == 0 and not any(char.isdigit() for char in pattern)
+                and _KNOWN_NAMES.isdisjoint(name_regex.findall(pattern))):
+            # No dice, numbers or known names, so this is just text rather than a roll.
+            return None
         try:
-            result = Calc.evaluate(pattern)
-            if self.round_decimals >= 0:
-                result = round(result, self.round_decimals)
+            # A rolled XdY is never longer than its input today, but cap the expanded
+            # expression anyway so the parser's work stays bounded.
+            if len(pattern) > 256:
+                raise ValueError("Expanded pattern too long")
+            result = evaluate(pattern)
+            if round_decimals >= 0:
+                result = round(result, round_decimals)
             result = str(result)
-            if len(result) > self.result_max_length:
+            if len(result) > result_max_length:
                 raise ValueError("Result too long")
         except (TypeError, NameError, ValueError, SyntaxError, KeyError, OverflowError,
                 ZeroDivisionError):
             self.log.debug(f"Failed to evaluate `{pattern}`", exc_info=True)
-            await evt.reply("Bad pattern 3:<")
-            return
-        if self.show_statement and pattern != result:
+            return None
+        if show_statement and pattern != result:
             result = f"{pattern} = {result}"
         if individual_rolls:
             result += "\n\n"
             result += "\n".join(f"{number}d{size}: {' '.join(str(result) for result in results)}  "
                                 for number, size, results in individual_rolls)
-        await evt.reply(result)
+        return result